@@ -1,10 +1,15 @@
+import logging
 import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 from openslide import OpenSlide
 from Aslide.kfb.kfb_slide import KfbSlide 
 from Aslide.tmap.tmap_slide import TmapSlide
 from Aslide.sdpc.sdpc_slide import SdpcSlide
 
+_log = logging.getLogger(__name__)
+
 
 class Slide(object):
 	def __init__(self, filepath):
@@ -14,21 +19,29 @@ class Slide(object):
 		# try reader one by one
 
 		read_success = False
+		error = None
+
+		# openslide reads none of the vendor formats, so they skip its probe
+		# (a file open and header sniff) and go straight to their own reader
+		vendor_format = self.format in ['.kfb', '.KFB', '.tmap', '.TMAP', '.sdpc', '.SDPC']
 
 		# 1. openslide
-		try:
-			self._osr = OpenSlide(filepath)
-			read_success = True
-		except:
-			pass
+		if not vendor_format:
+			try:
+				self._osr = OpenSlide(filepath)
+				read_success = True
+			except Exception as e:
+				_log.debug("OpenSlide could not read %s: %s", filepath, e)
+				error = e
 
 		# 2. kfb
 		if not read_success and self.format in ['.kfb', '.KFB']:
 			try:
 				self._osr = KfbSlide(filepath)
 				read_success = True
-			except:
-				pass
+			except Exception as e:
+				_log.warning("KfbSlide could not read %s: %s", filepath, e)
+				error = e
 
 		# 3. tmap
 		if not read_success and self.format in ['.tmap', '.TMAP']:
@@ -36,8 +49,9 @@ class Slide(object):
 				self._osr = TmapSlide(filepath)
 				if self._osr:
 					read_success = True
-			except:
-				pass
+			except Exception as e:
+				_log.warning("TmapSlide could not read %s: %s", filepath, e)
+				error = e
 
 		# 4. sdpc
 		if not read_success and self.format in ['.sdpc', '.SDPC']:
@@ -45,11 +59,12 @@ class Slide(object):
 				self._osr = SdpcSlide(filepath)
 				if self._osr:
 					read_success = True
-			except:
-				pass
+			except Exception as e:
+				_log.warning("SdpcSlide could not read %s: %s", filepath, e)
+				error = e
 
 		if not read_success:
-			raise Exception("UnsupportedFormat or ReadingFailed => %s" % filepath)
+			raise Exception("UnsupportedFormat or ReadingFailed => %s" % filepath) from error
 
 	def __enter__(self):
 		return self
@@ -132,10 +147,40 @@ class Slide(object):
 		"""
 		return self._osr.read_fixed_region(location, level, size)
 
+	@classmethod
+	def read_regions(cls, filepath, locations, level, size, workers=None):
+		"""
+		return many region images of one slide, read in parallel by worker processes
+		that each open the slide once and keep it for all of their reads
+		:param filepath:  (str) – path to the slide
+		:param locations:  (list) – (x, y) tuples, as for read_region
+		:param level:  (int) – the level number
+		:param size:  (tuple) – (width, height) tuple giving the region size
+		:param workers:  (int) – number of worker processes, defaults to the CPU count
+		:return: list of PIL.Image objects, in the order of locations
+		"""
+		with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+								 initargs=(cls, filepath)) as executor:
+			return list(executor.map(partial(_read_region_worker, level=level, size=size),
+									 locations, chunksize=16))
+
 	def close(self):
 		self._osr.close()
 
 
+# slide opened by each read_regions() worker process
+_worker_slide = None
+
+
+def _init_worker(cls, filepath):
+	global _worker_slide
+	_worker_slide = cls(filepath)
+
+
+def _read_region_worker(location, level, size):
+	return _worker_slide.read_region(location, level, size)
+
+
 if __name__ == '__main__':
 	filepath = 'path/to/your/slide'
 	slide = Slide(filepath)
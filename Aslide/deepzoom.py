@@ -1,20 +1,138 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
 from openslide.deepzoom import DeepZoomGenerator as OpenSlideDZG
 
 from Aslide.kfb.kfb_deepzoom import DeepZoomGenerator as KfbDZG
 from Aslide.tmap.tmap_deepzoom import DeepZoomGenerator as TmapDZG
 
 
+def _part1by1(v):
+    # spread the low 16 bits of v over the even bit positions
+    v &= 0x0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F
+    v = (v | (v << 2)) & 0x33333333
+    v = (v | (v << 1)) & 0x55555555
+    return v
+
+
+def _morton_key(address):
+    level, (col, row) = address
+    return level, _part1by1(col) | (_part1by1(row) << 1)
+
+
+class SQLiteTileCache(object):
+    """Persistent tile cache storing encoded tiles as BLOBs in a SQLite file.
+
+    Any object exposing ``get(key) -> bytes or None`` and ``put(key, data)``
+    can be passed to ADeepZoomGenerator instead."""
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS tiles '
+                           '(key BLOB PRIMARY KEY, data BLOB NOT NULL)')
+        self._conn.commit()
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self._path)
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute('SELECT data FROM tiles WHERE key = ?',
+                                     (key,)).fetchone()
+        return bytes(row[0]) if row is not None else None
+
+    def put(self, key, data):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO tiles (key, data) VALUES (?, ?)',
+                               (key, sqlite3.Binary(data)))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
 class ADeepZoomGenerator(object):
-    def __init__(self, osr, tile_size=254, overlap=1, limit_bounds=False):
+    # Worker threads used by get_tiles() and prefetch_tiles()
+    MAX_WORKERS = 8
+    # Worker threads and queue bound for the neighbour prefetch
+    MAX_PREFETCH_WORKERS = 2
+    MAX_PREFETCH_PENDING = 16
+
+    def __init__(self, osr, tile_size=254, overlap=1, limit_bounds=False, cache=None,
+                 tile_cache_size=0, prefetch_neighbours=False):
         if osr.format in ['.kfb', '.KFB']:
-            self._dzg = KfbDZG(osr, tile_size, overlap, limit_bounds)
+            # hand over the KfbSlide itself, so tiles can be decoded downscaled
+            self._dzg = KfbDZG(osr._osr, tile_size, overlap, limit_bounds)
         elif osr.format in ['.sdpc', '.SDPC']:
             raise NotImplementedError("UnsupportedFormat or Missing File => %s" % osr.filepath)
         elif osr.format in ['.tmap', '.TMAP']:
-            self._dzg = TmapDZG(osr, 256, overlap, limit_bounds)
+            # TMAP tiles come straight from the SDK, at its native tile size
+            tile_size = osr._osr.get_tile_size[0]
+            self._dzg = TmapDZG(osr, tile_size, overlap, limit_bounds)
         else:
             self._dzg = OpenSlideDZG(osr, tile_size, overlap, limit_bounds)
 
+        # tiles are keyed on the slide file and its mtime, so a rescanned
+        # slide never serves stale tiles
+        self._cache = cache
+        if cache is not None:
+            filepath = os.path.abspath(osr.filepath)
+            self._cache_prefix = (filepath, os.path.getmtime(filepath),
+                                  tile_size, overlap, limit_bounds)
+
+        # up to tile_cache_size rendered tiles, so that panning back over a
+        # region does not read and resize it again; off by default, as each
+        # tile holds about 200 KB
+        self._tile_cache_size = tile_cache_size
+        self._tile_cache = OrderedDict()
+        self._tile_cache_lock = threading.Lock()
+        # render the ring of tiles around each requested one in the
+        # background, as a pan usually moves onto them next
+        self._prefetch_neighbours = prefetch_neighbours
+
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        # neighbour renders run on a pool of their own, so they never queue
+        # ahead of tiles a caller is waiting for; keyed on (level, col, row),
+        # oldest first
+        self._prefetch_executor = None
+        self._prefetch_pending = OrderedDict()
+        self._prefetch_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+        return False
+
+    def close(self):
+        """Stop the worker threads. Queued neighbour prefetches are dropped,
+        other queued tiles are still rendered first. The slide and the tile
+        cache belong to the caller and stay open."""
+        with self._prefetch_lock:
+            prefetch_executor, self._prefetch_executor = self._prefetch_executor, None
+            dropped = list(self._prefetch_pending.values())
+            self._prefetch_pending.clear()
+        # cancel() runs _prefetch_done right away, which takes the lock
+        for future in dropped:
+            future.cancel()
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        for executor in (prefetch_executor, executor):
+            if executor is not None:
+                executor.shutdown(wait=True)
+
     @property
     def level_count(self):
         """The number of Deep Zoom levels in the image."""
@@ -50,7 +168,144 @@ class ADeepZoomGenerator(object):
         :param address:  the address of the tile within the level as a (col, row) tuple.
         :return: Return an RGB PIL.Image for a tile
         """
-        return self._dzg.get_tile(level, address)
+        col, row = address
+        tile = self._get_tile_cached(level, col, row)
+        if self._tile_cache_size:
+            # hand out a copy, callers may draw on the tile
+            tile = tile.copy()
+        if self._prefetch_neighbours:
+            self._submit_neighbours(level, col, row)
+        return tile
+
+    def get_tiles(self, addresses):
+        """
+
+        :param addresses: a list of (level, (col, row)) tuples
+        :return: a list of RGB PIL.Image tiles, in the order of addresses
+        """
+        # SDK reads on one slide are serialized per handle, but they run in C
+        # with the GIL released, so the read of one tile overlaps with the
+        # decoding and resizing of another; tiles are dispatched in Z-order
+        # so that neighbours, which share native tiles, run close together
+        # while those are still cached
+        addresses = [(level, tuple(address)) for level, address in addresses]
+        executor = self._get_executor()
+        futures = {}
+        for level, address in sorted(set(addresses), key=_morton_key):
+            futures[level, address] = executor.submit(self.get_tile, level, address)
+        return [futures[level, address].result() for level, address in addresses]
+
+    def prefetch_tiles(self, level, addresses, format='jpeg', quality=75):
+        """
+        Render tiles in the background, e.g. the region a viewer is about to
+        pan to, so that later requests for them are cache hits. With a tile
+        cache the tiles are also encoded into it; without one they are kept
+        in the in-memory tile LRU, and nothing is done if that is disabled.
+
+        :param level: the Deep Zoom level
+        :param addresses: a list of (col, row) tuples within the level
+        :param format: the format of the encoded tiles ('png' or 'jpeg')
+        :param quality: the JPEG quality used when encoding the tiles
+        """
+        if self._cache is None and not self._tile_cache_size:
+            return
+        executor = self._get_executor()
+        for col, row in sorted(addresses, key=lambda address: _morton_key((level, address))):
+            if self._cache is not None:
+                executor.submit(self.get_tile_bytes, level, (col, row), format, quality)
+            else:
+                executor.submit(self._get_tile_cached, level, col, row)
+
+    def get_tile_bytes(self, level, address, format='jpeg', quality=75):
+        """
+
+        :param level: the Deep Zoom level
+        :param address:  the address of the tile within the level as a (col, row) tuple.
+        :param format: the format of the encoded tile ('png' or 'jpeg')
+        :param quality: the JPEG quality used when encoding the tile
+        :return: the encoded tile, served from the tile cache when possible
+        """
+        if self._cache is not None:
+            key = self._cache_key(level, address, format, quality)
+            data = self._cache.get(key)
+            if data is not None:
+                return data
+
+        buf = BytesIO()
+        col, row = address
+        self._get_tile_cached(level, col, row).save(buf, format, quality=quality)
+        data = buf.getvalue()
+
+        if self._cache is not None:
+            self._cache.put(key, data)
+        return data
+
+    def _submit_neighbours(self, level, col, row):
+        if not self._tile_cache_size:
+            return
+        cols, rows = self.level_tiles[level]
+        submitted = []
+        dropped = []
+        with self._prefetch_lock:
+            if self._prefetch_executor is None:
+                self._prefetch_executor = ThreadPoolExecutor(max_workers=self.MAX_PREFETCH_WORKERS)
+            for n_col in range(max(0, col - 1), min(cols, col + 2)):
+                for n_row in range(max(0, row - 1), min(rows, row + 2)):
+                    key = (level, n_col, n_row)
+                    if (n_col, n_row) == (col, row) or key in self._prefetch_pending:
+                        continue
+                    with self._tile_cache_lock:
+                        if key in self._tile_cache:
+                            continue
+                    future = self._prefetch_executor.submit(self._get_tile_cached, *key)
+                    self._prefetch_pending[key] = future
+                    submitted.append((key, future))
+            # the view has moved on from the oldest requests; drop those
+            # that have not started yet
+            while len(self._prefetch_pending) > self.MAX_PREFETCH_PENDING:
+                dropped.append(self._prefetch_pending.popitem(last=False)[1])
+        # outside the lock, as both cancel() and adding a callback to a
+        # finished future run _prefetch_done right away
+        for future in dropped:
+            future.cancel()
+        for key, future in submitted:
+            future.add_done_callback(lambda f, key=key: self._prefetch_done(key, f))
+
+    def _prefetch_done(self, key, future):
+        with self._prefetch_lock:
+            if self._prefetch_pending.get(key) is future:
+                del self._prefetch_pending[key]
+
+    def _get_tile_cached(self, level, col, row):
+        if not self._tile_cache_size:
+            return self._get_tile_uncached(level, col, row)
+        key = (level, col, row)
+        with self._tile_cache_lock:
+            tile = self._tile_cache.get(key)
+            if tile is not None:
+                self._tile_cache.move_to_end(key)
+                return tile
+        tile = self._get_tile_uncached(level, col, row)
+        with self._tile_cache_lock:
+            self._tile_cache[key] = tile
+            self._tile_cache.move_to_end(key)
+            while len(self._tile_cache) > self._tile_cache_size:
+                self._tile_cache.popitem(last=False)
+        return tile
+
+    def _get_tile_uncached(self, level, col, row):
+        return self._dzg.get_tile(level, (col, row))
+
+    def _cache_key(self, level, address, format, quality):
+        col, row = address
+        key = self._cache_prefix + (level, col, row, format.lower(), quality)
+        return hashlib.blake2b(repr(key).encode('UTF-8'), digest_size=8).digest()
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.MAX_WORKERS)
+            return self._executor
 
 
 if __name__ == '__main__':
@@ -27,7 +27,7 @@ from __future__ import division
 from io import BytesIO
 import math
 import openslide
-from PIL import Image
+from PIL import Image, ImageColor
 from Aslide.kfb.kfb_slide import KfbSlide
 from xml.etree.ElementTree import ElementTree, Element, SubElement
 
@@ -38,6 +38,10 @@ class DeepZoomGenerator(object):
                 openslide.PROPERTY_NAME_BOUNDS_Y)
     BOUNDS_SIZE_PROPS = (openslide.PROPERTY_NAME_BOUNDS_WIDTH,
                 openslide.PROPERTY_NAME_BOUNDS_HEIGHT)
+    # Largest slide level (in pixels) read whole to render a Deep Zoom level
+    LEVEL_IMAGE_MAX_PIXELS = 4096 * 4096
+    # Number of highest-resolution Deep Zoom levels resampled with Lanczos
+    LANCZOS_LEVELS = 3
 
     def __init__(self, osr, tile_size=254, overlap=1, limit_bounds=False):
         """Create a DeepZoomGenerator wrapping an OpenSlide object.
@@ -57,6 +61,8 @@ class DeepZoomGenerator(object):
         # - Pixel coordinates within slide level 0 (l0_)
 
         self._osr = osr
+        # KfbSlide can decode straight to a reduced size
+        self._read_draft = isinstance(osr, KfbSlide)
         self._z_t_downsample = tile_size
         self._z_overlap = overlap
         self._limit_bounds = limit_bounds
@@ -110,9 +116,38 @@ class DeepZoomGenerator(object):
                     self._l0_l_downsamples[self._slide_from_dz_level[dz_level]]
                     for dz_level in range(self._dz_levels))
 
-        # Slide background color
-        self._bg_color = '#' + self._osr.properties.get(
-                        openslide.PROPERTY_NAME_BACKGROUND_COLOR, 'ffffff')
+        # Resampling filter for each Deep Zoom level; the visual difference
+        # of Lanczos over bilinear is lost on heavily downsampled levels
+        self._z_resample = tuple(
+                    Image.LANCZOS if dz_level >= self._dz_levels - self.LANCZOS_LEVELS
+                    else Image.BILINEAR
+                    for dz_level in range(self._dz_levels))
+
+        # Slide background color, parsed once into an RGB tuple
+        self._bg_color = ImageColor.getrgb('#' + self._osr.properties.get(
+                        openslide.PROPERTY_NAME_BACKGROUND_COLOR, 'ffffff'))
+        # Solid background images by size; composite() only reads them
+        self._bg_cache = {}
+
+        # Deep Zoom levels coarser than the coarsest slide level are rendered
+        # once from that whole slide level and then sliced into tiles
+        coarsest = len(self._l0_l_downsamples) - 1
+        l_w, l_h = self._l_dimensions[coarsest]
+        self._level_image_levels = frozenset(
+                    dz_level for dz_level in range(self._dz_levels)
+                    if self._slide_from_dz_level[dz_level] == coarsest
+                    and self._l_z_downsamples[dz_level] > 1
+                    and l_w * l_h <= self.LEVEL_IMAGE_MAX_PIXELS)
+        self._level_image_cache = {}
+
+        # Per Deep Zoom level constants looked up by _get_tile_info()
+        self._dz_level_info = tuple(
+                    (self._slide_from_dz_level[dz_level],
+                    self._l_z_downsamples[dz_level],
+                    self._t_dimensions[dz_level],
+                    self._z_dimensions[dz_level],
+                    self._l_dimensions[self._slide_from_dz_level[dz_level]])
+                    for dz_level in range(self._dz_levels))
 
     def __repr__(self):
         return '%s(%r, tile_size=%r, overlap=%r, limit_bounds=%r)' % (
@@ -146,72 +181,99 @@ class DeepZoomGenerator(object):
         address:   the address of the tile within the level as a (col, row)
                    tuple."""
 
+        if level in self._level_image_levels:
+            return self._get_level_image_tile(level, address)
+
         # Read tile
         args, z_size = self._get_tile_info(level, address)
-        tile = self._osr.read_region(*args)
+        tile = self._read_region(args, z_size)
         # print(tile.format, tile.size, tile.mode)
         # print(dir(self._osr))
         # tile = self._osr.read_fixed_region(*args)
 
         # Apply on solid background
-        bg = Image.new('RGB', tile.size, self._bg_color)
-        # print(bg.format, bg.size, bg.mode)
-        tile = Image.composite(tile, bg, tile)
+        tile = self._apply_bg(tile)
 
-        # Scale to the correct size
+        # Scale to the correct size in a single resampling pass
         if tile.size != z_size:
-            tile.thumbnail(z_size, Image.ANTIALIAS)
+            tile = tile.resize(z_size, self._z_resample[level])
 
         return tile
 
+    def _get_level_image_tile(self, dz_level, t_location):
+        z_size = self._get_tile_info(dz_level, t_location)[1]
+        level_image = self._level_image_cache.get(dz_level)
+        if level_image is None:
+            slide_level = self._slide_from_dz_level[dz_level]
+            region = self._read_region(((0, 0), slide_level,
+                        self._l_dimensions[slide_level]),
+                        self._z_dimensions[dz_level])
+            region = self._apply_bg(region)
+            level_image = region.resize(self._z_dimensions[dz_level],
+                        self._z_resample[dz_level])
+            self._level_image_cache[dz_level] = level_image
+
+        z_left, z_top = (self._z_from_t(t) - self._z_overlap * int(t != 0)
+                    for t in t_location)
+        return level_image.crop((z_left, z_top,
+                    z_left + z_size[0], z_top + z_size[1]))
+
+    def _read_region(self, args, z_size):
+        if self._read_draft:
+            return self._osr.read_region(*args, target_size=z_size)
+        return self._osr.read_region(*args)
+
+    def _apply_bg(self, tile):
+        # the SDK hands out decoded JPEGs widened to RGBA, so the alpha band
+        # is nearly always opaque; dropping it is then enough
+        if tile.mode == 'RGBA' and tile.getchannel('A').getextrema()[0] < 255:
+            return Image.composite(tile, self._get_bg(tile.size), tile)
+        return tile.convert('RGB')
+
+    def _get_bg(self, size):
+        bg = self._bg_cache.get(size)
+        if bg is None:
+            bg = self._bg_cache.setdefault(size,
+                        Image.new('RGB', size, self._bg_color))
+        return bg
+
     def _get_tile_info(self, dz_level, t_location):
         # Check parameters
         if dz_level < 0 or dz_level >= self._dz_levels:
             raise ValueError("Invalid level")
-        for t, t_lim in zip(t_location, self._t_dimensions[dz_level]):
-            if t < 0 or t >= t_lim:
-                raise ValueError("Invalid address")
+        (slide_level, l_z_downsample, (t_cols, t_rows), (z_w, z_h),
+                    (l_w, l_h)) = self._dz_level_info[dz_level]
+        t_col, t_row = t_location
+        if t_col < 0 or t_col >= t_cols or t_row < 0 or t_row >= t_rows:
+            raise ValueError("Invalid address")
 
-        # Get preferred slide level
-        slide_level = self._slide_from_dz_level[dz_level]
+        z_t_downsample = self._z_t_downsample
+        z_overlap = self._z_overlap
 
         # Calculate top/left and bottom/right overlap
-        z_overlap_tl = tuple(self._z_overlap * int(t != 0)
-                    for t in t_location)
-        z_overlap_br = tuple(self._z_overlap * int(t != t_lim - 1)
-                    for t, t_lim in
-                    zip(t_location, self.level_tiles[dz_level]))
+        z_tl_x = z_overlap * int(t_col != 0)
+        z_tl_y = z_overlap * int(t_row != 0)
+        z_br_x = z_overlap * int(t_col != t_cols - 1)
+        z_br_y = z_overlap * int(t_row != t_rows - 1)
 
         # Get final size of the tile
-        z_size = tuple(min(self._z_t_downsample,
-                    z_lim - self._z_t_downsample * t) + z_tl + z_br
-                    for t, z_lim, z_tl, z_br in
-                    zip(t_location, self._z_dimensions[dz_level],
-                    z_overlap_tl, z_overlap_br))
+        z_size = (min(z_t_downsample, z_w - z_t_downsample * t_col) + z_tl_x + z_br_x,
+                  min(z_t_downsample, z_h - z_t_downsample * t_row) + z_tl_y + z_br_y)
 
         # Obtain the region coordinates
-        z_location = [self._z_from_t(t) for t in t_location]
-        l_location = [self._l_from_z(dz_level, z - z_tl)
-                    for z, z_tl in zip(z_location, z_overlap_tl)]
-
-
-        # Round location down and size up, and add offset of active area
-        l0_location = tuple(int(self._l0_from_l(slide_level, l) + l0_off)
-                    for l, l0_off in zip(l_location, self._l0_offset))
-
+        l_x = l_z_downsample * (z_t_downsample * t_col - z_tl_x)
+        l_y = l_z_downsample * (z_t_downsample * t_row - z_tl_y)
 
-        l_size = tuple(int(min(math.ceil(self._l_from_z(dz_level, dz)),
-                    l_lim - math.ceil(l)))
-                    for l, dz, l_lim in
-                    zip(l_location, z_size, self._l_dimensions[slide_level]))
+        # Round size up, clipped to the slide level
+        l_size = (int(min(math.ceil(l_z_downsample * z_size[0]), l_w - math.ceil(l_x))),
+                  int(min(math.ceil(l_z_downsample * z_size[1]), l_h - math.ceil(l_y))))
 
         # Return read_region() parameters plus tile size for final scaling
-        # return ((l0_location, slide_level, l_size), z_size)
 
         # difference with openslide read_region, 
         # kfb - (x, y) is based on current level
         # openslid - (x, y) is based on 0 level
-        return ((tuple(l_location), slide_level, l_size), z_size)
+        return (((l_x, l_y), slide_level, l_size), z_size)
 
     def _l0_from_l(self, slide_level, l):
         return self._l0_l_downsamples[slide_level] * l
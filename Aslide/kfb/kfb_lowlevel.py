@@ -6,7 +6,7 @@ import platform
 import sys
 import io
 import os
-import numpy as np
+import threading
 from openslide import lowlevel
 from openslide.lowlevel import OpenSlideError, OpenSlideUnsupportedFormatError
 from openslide._version import __version__
@@ -25,6 +25,13 @@ except:
     soPath = os.path.join(dirname, 'lib/libkfbslide.so')
     _lib = cdll.LoadLibrary(soPath)
 
+# optional libjpeg-turbo decoder; without it regions are decoded by PIL
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGBA
+    _turbojpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _turbojpeg = None
+
 class KFBSlideError(Exception):
     """docstring for KFBSlideError"""
 
@@ -34,6 +41,9 @@ class _KfbSlide(object):
         self._as_parameter_ = ptr
         self._valid = True
         self._close = kfbslide_close
+        # nothing says the SDK is thread-safe, so reads on one handle are
+        # serialized; only the JPEG decode runs concurrently
+        self._lock = threading.Lock()
 
     def __del__(self):
         if self._valid:
@@ -129,25 +139,53 @@ _kfbslide_read_region = _func("kfbslide_read_region", c_bool, [_KfbSlide, c_int3
 
 _kfbslide_read_roi_region = _func("kfbslide_get_image_roi_stream", c_bool, [_KfbSlide, c_int32, c_int64, c_int64, c_int64, c_int64, POINTER(c_int), POINTER(POINTER(c_ubyte))])
 
+def _decode_region(data, target_size=None):
+    if _turbojpeg is not None and data[:2] == b'\xff\xd8':
+        return _decode_region_turbo(data, target_size)
+    img = PIL.Image.open(io.BytesIO(data))
+    # when the region is headed for a downscale, let libjpeg do the first
+    # 1/2 to 1/8 of it in the DCT; the result stays at least target_size
+    if target_size is not None:
+        img.draft('RGB', target_size)
+    return img.convert('RGBA')
+
+def _decode_region_turbo(data, target_size=None):
+    # same result as the PIL path, decoded straight to RGBA (alpha 0xff) by
+    # libjpeg-turbo, with the same DCT scaling as draft()
+    scaling_factor = None
+    if target_size is not None:
+        width, height = _turbojpeg.decode_header(data)[:2]
+        for denom in (8, 4, 2):
+            if -(-width // denom) >= target_size[0] and -(-height // denom) >= target_size[1]:
+                scaling_factor = (1, denom)
+                break
+    return PIL.Image.fromarray(_turbojpeg.decode(data, pixel_format=TJPF_RGBA,
+                                                 scaling_factor=scaling_factor))
+
 def kfbslide_read_region(osr, level, pos_x, pos_y):
     data_length = c_int()
     pixel = POINTER(c_ubyte)()
-    if not _kfbslide_read_region( osr, level, pos_x, pos_y, byref(data_length), byref(pixel)):
-        raise ValueError("Fail to read region")
+    with osr._lock:
+        if not _kfbslide_read_region( osr, level, pos_x, pos_y, byref(data_length), byref(pixel)):
+            raise ValueError("Fail to read region")
+        # copy the stream out before the next call on the handle can touch it
+        data = string_at(pixel, data_length.value)
     # import numpy as np
     # return np.ctypeslib.as_array(pixel, shape=(data_length.value,))
-    return PIL.Image.open(io.BytesIO(np.ctypeslib.as_array(pixel, shape=(data_length.value,)))).convert('RGBA')
+    return _decode_region(data)
 
-def kfbslide_read_roi_region(osr, level, pos_x, pos_y, width, height):
+def kfbslide_read_roi_region(osr, level, pos_x, pos_y, width, height, target_size=None):
     data_length = c_int()
     pixel = POINTER(c_ubyte)()
-    if not _kfbslide_read_roi_region( osr, level, pos_x, pos_y, width, height, byref(data_length), byref(pixel)):
-        raise ValueError("Fail to read roi region")
+    with osr._lock:
+        if not _kfbslide_read_roi_region( osr, level, pos_x, pos_y, width, height, byref(data_length), byref(pixel)):
+            raise ValueError("Fail to read roi region")
+        data = string_at(pixel, data_length.value)
     # img = PIL.Image.frombuffer('RGBA', (width, height), pixel, 'raw', 'RGBA', 0, 1)
 
     # import numpy as np
     # return np.ctypeslib.as_array(pixel, shape=(data_length.value,))
-    return PIL.Image.open(io.BytesIO(np.ctypeslib.as_array(pixel, shape=(data_length.value,)))).convert('RGBA')
+    return _decode_region(data, target_size)
 
 kfbslide_property_names = _func("kfbslide_get_property_names", POINTER(c_char_p),
                                     [_KfbSlide], _check_name_list)
@@ -177,15 +215,13 @@ def kfbslide_get_associated_image_dimensions( osr, name):
 _kfbslide_read_associated_image = _func("kfbslide_read_associated_image", c_void_p, [_KfbSlide, lowlevel._utf8_p, POINTER(POINTER(c_ubyte))])
 
 def kfbslide_read_associated_image(osr, name):
-    data_length = kfbslide_get_associated_image_dimensions(osr, name)[1]
     pixel = POINTER(c_ubyte)()
-    _kfbslide_read_associated_image(osr, name, byref(pixel))
-    import numpy as np
-    narray = np.ctypeslib.as_array(pixel, shape=(data_length,))
-    from io import BytesIO
-    buf = BytesIO(narray)
-    from PIL import Image
-    return Image.open(buf)
+    with osr._lock:
+        data_length = kfbslide_get_associated_image_dimensions(osr, name)[1]
+        _kfbslide_read_associated_image(osr, name, byref(pixel))
+        # copy the encoded image out of SDK memory in one step
+        data = string_at(pixel, data_length)
+    return PIL.Image.open(io.BytesIO(data))
 
 def main():
     kfb_file_path = "/path/to/kfb/file"
@@ -1,18 +1,39 @@
 import io
+import logging
+import threading
+from collections import OrderedDict
 from Aslide.kfb import kfb_lowlevel
 from PIL import Image
 from openslide import AbstractSlide, _OpenSlideMap
 
+_log = logging.getLogger(__name__)
+
 
 class kfbRef:
     img_count = 0
 
 
 class KfbSlide(AbstractSlide):
-    def __init__(self, filename):
+    def __init__(self, filename, tile_cache_size=0):
         AbstractSlide.__init__(self)
         self.__filename = filename
         self._osr = kfb_lowlevel.kfbslide_open(filename)
+        # up to tile_cache_size decoded native tiles for read_fixed_region(),
+        # as overlapping reads while panning hit the same ones again; off by
+        # default, as each RGBA tile holds about 256 KB.
+        # keyed on (level, x, y), most recently used last
+        self._tile_cache_size = tile_cache_size
+        self._tile_cache = OrderedDict()
+        self._tile_cache_lock = threading.Lock()
+        self._associated_images = None
+
+        # the pyramid geometry is fixed once the file is open; query the SDK
+        # for it here rather than on every property access
+        level_count = kfb_lowlevel.kfbslide_get_level_count(self._osr)
+        self._level_dimensions = tuple(kfb_lowlevel.kfbslide_get_level_dimensions(self._osr, i)
+                                       for i in range(level_count))
+        self._level_downsamples = tuple(kfb_lowlevel.kfbslide_get_level_downsample(self._osr, i)
+                                        for i in range(level_count))
 
     def __repr__(self):
         return '%s(%r)' % (self.__class__.__name__, self.__filename)
@@ -22,21 +43,21 @@ class KfbSlide(AbstractSlide):
         return kfb_lowlevel.detect_vendor(filename)
 
     def close(self):
+        with self._tile_cache_lock:
+            self._tile_cache.clear()
         kfb_lowlevel.kfbslide_close(self._osr)
 
     @property
     def level_count(self):
-        return kfb_lowlevel.kfbslide_get_level_count(self._osr)
+        return len(self._level_downsamples)
 
     @property
     def level_dimensions(self):
-        return tuple(kfb_lowlevel.kfbslide_get_level_dimensions(self._osr, i)
-                     for i in range(self.level_count))
+        return self._level_dimensions
 
     @property
     def level_downsamples(self):
-        return tuple(kfb_lowlevel.kfbslide_get_level_downsample(self._osr, i)
-                     for i in range(self.level_count))
+        return self._level_downsamples
 
     @property
     def properties(self):
@@ -44,7 +65,9 @@ class KfbSlide(AbstractSlide):
 
     @property
     def associated_images(self):
-        return _AssociatedImageMap(self._osr)
+        if self._associated_images is None:
+            self._associated_images = _AssociatedImageMap(self._osr)
+        return self._associated_images
 
     def get_best_level_for_downsample(self, downsample):
         return kfb_lowlevel.kfbslide_get_best_level_for_downsample(self._osr, downsample)
@@ -56,10 +79,29 @@ class KfbSlide(AbstractSlide):
         y = int(location[1])
         img_index = kfbRef.img_count
         kfbRef.img_count += 1
-        print("img_index : ", img_index, "Level : ", level, "Location : ", x , y)
-        return kfb_lowlevel.kfbslide_read_region(self._osr, level, x, y)
-
-    def read_region(self, location, level, size):
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug("img_index : %d Level : %d Location : %d %d", img_index, level, x, y)
+
+        if not self._tile_cache_size:
+            return kfb_lowlevel.kfbslide_read_region(self._osr, level, x, y)
+
+        key = (level, x, y)
+        with self._tile_cache_lock:
+            tile = self._tile_cache.get(key)
+            if tile is not None:
+                self._tile_cache.move_to_end(key)
+        if tile is None:
+            tile = kfb_lowlevel.kfbslide_read_region(self._osr, level, x, y)
+            with self._tile_cache_lock:
+                self._tile_cache[key] = tile
+                if len(self._tile_cache) > self._tile_cache_size:
+                    self._tile_cache.popitem(last=False)
+        # callers may draw on the tile, keep the cached one intact
+        return tile.copy()
+
+    def read_region(self, location, level, size, target_size=None):
+        """Return a PIL.Image of the region, decoded at no less than
+        target_size when that is given."""
         x = int(location[0])
         y = int(location[1])
         width = int(size[0])
@@ -67,14 +109,20 @@ class KfbSlide(AbstractSlide):
         img_index = kfbRef.img_count
         kfbRef.img_count += 1
 
-        return kfb_lowlevel.kfbslide_read_roi_region(self._osr, level, x, y, width, height)
+        return kfb_lowlevel.kfbslide_read_roi_region(self._osr, level, x, y, width, height,
+                                                     target_size)
 
     def get_thumbnail(self, size):
         """Return a PIL.Image containing an RGB thumbnail of the image.
 
         size:     the maximum size of the thumbnail."""
 
-        thumb = self.associated_images[b'thumbnail']
+        thumb = self.associated_images['thumbnail']
+        # let libjpeg scale by 1/2 to 1/8 in the DCT while decoding, then
+        # finish the last step to the requested size
+        thumb.draft('RGB', size)
+        thumb = thumb.convert('RGB')
+        thumb.thumbnail(size, Image.LANCZOS)
         return thumb
 
 
@@ -90,11 +138,18 @@ class _KfbPropertyMap(_OpenSlideMap):
 
 
 class _AssociatedImageMap(_OpenSlideMap):
+    def __init__(self, osr):
+        _OpenSlideMap.__init__(self, osr)
+        # the names never change for an open slide; ask the SDK once and
+        # answer membership tests from a set
+        self._names = kfb_lowlevel.kfbslide_get_associated_image_names(osr)
+        self._name_set = frozenset(self._names)
+
     def _keys(self):
-        return kfb_lowlevel.kfbslide_get_associated_image_names(self._osr)
+        return self._names
 
     def __getitem__(self, key):
-        if key not in self._keys():
+        if key not in self._name_set:
             raise KeyError()
         return kfb_lowlevel.kfbslide_read_associated_image(self._osr, key)
 
@@ -1,7 +1,6 @@
 import numpy.ctypeslib as npCtypes
 import ctypes
 from ctypes import *
-import gc
 import os
 import sys
 from PIL import Image
@@ -15,20 +14,38 @@ soPath = os.path.join(dirname, 'so/libDecodeSdpc.so')
 
 # load dll
 so = ctypes.CDLL(soPath)
+# every entry point gets a full prototype once here, so calls are converted
+# against fixed argtypes instead of ctypes guessing from each Python argument
+so.GetLayerInfo.argtypes = [POINTER(SqSdpcInfo), c_int]
 so.GetLayerInfo.restype = POINTER(c_char)
 so.SqGetRoiRgbOfSpecifyLayer.argtypes = [POINTER(SqSdpcInfo), POINTER(POINTER(c_uint8)),
                                          c_int, c_int, c_uint, c_uint, c_int]
 so.SqGetRoiRgbOfSpecifyLayer.restype = c_int
+so.SqOpenSdpc.argtypes = [c_char_p]
 so.SqOpenSdpc.restype = POINTER(SqSdpcInfo)
+so.SqCloseSdpc.argtypes = [POINTER(SqSdpcInfo)]
+so.SqCloseSdpc.restype = None
+so.Dispose.argtypes = [POINTER(c_uint8)]
+so.Dispose.restype = None
 
 
 class SdpcSlide:
+    # Largest slide level (in pixels) read whole to render a thumbnail
+    THUMBNAIL_MAX_PIXELS = 4096 * 4096
 
-    def __init__(self, sdpcPath):
+    def __init__(self, sdpcPath, preload_top_levels=0):
         self.sdpc = self.readSdpc(sdpcPath)
         self.level_count = self.getLevelCount()
         self.level_downsamples = self.getLevelDownsamples()
         self.level_dimensions = self.getLevelDimensions()
+        # get_best_level_for_downsample() matches against the squared downsamples
+        self._level_presets = tuple(i * i for i in self.level_downsamples)
+
+        # the coarsest levels are small and hit on every navigation; when
+        # asked, decode them whole once and serve reads by cropping
+        self._rendered_levels = {}
+        for level in range(max(0, self.level_count - preload_top_levels), self.level_count):
+            self._rendered_levels[level] = self.read_region((0, 0), level, self.level_dimensions[level])
 
     def getRgb(self, rgbPos, width, height):
 
@@ -57,11 +74,9 @@ class SdpcSlide:
         return tuple(_list)
     
     def get_best_level_for_downsample(self, downsample):
-      
-        preset = [i*i for i in self.level_downsamples]
-        err = [abs(i-downsample) for i in preset]
-        level = err.index(min(err))
-        return level
+        # first level with the smallest error, as list.index(min(err)) gave
+        presets = self._level_presets
+        return min(range(len(presets)), key=lambda i: abs(presets[i] - downsample))
 
     def read_region(self, location, level, size):
 
@@ -72,53 +87,71 @@ class SdpcSlide:
 
         width, height = size
 
+        rendered = self._rendered_levels.get(level)
+        if rendered is not None:
+            return rendered.crop((startX, startY, startX + width, startY + height))
+
         rgbPos = POINTER(c_uint8)()
         rgbPosPointer = byref(rgbPos)
         so.SqGetRoiRgbOfSpecifyLayer(self.sdpc, rgbPosPointer, width, height, startX, startY, level)
-        rgb = self.getRgb(rgbPos, width, height)[..., ::-1]
-        rgbCopy = rgb.copy()
+        # unpack the BGR pixels straight from the decoder's buffer; the raw
+        # decoder swaps the channels while copying, so the buffer can be
+        # released right after
+        content = ctypes.cast(rgbPos, POINTER(c_uint8 * (width * height * 3))).contents
+        image = Image.frombuffer('RGB', (width, height), content, 'raw', 'BGR', 0, 1)
 
         so.Dispose(rgbPos)
-        del rgbPos
-        del rgbPosPointer
-        gc.collect()
 
-        return Image.fromarray(rgbCopy)
+        return image
 
     def getLevelDimensions(self):
 
-        def findStrIndex(subStr, str):
-            index1 = str.find(subStr)
-            index2 = str.find(subStr, index1 + 1)
-            index3 = str.find(subStr, index2 + 1)
-            index4 = str.find(subStr, index3 + 1)
-            return index1, index2, index3, index4
-
         levelCount = self.getLevelCount()
         levelDimensions = []
         for level in range(levelCount):
             layerInfo = so.GetLayerInfo(self.sdpc, level)
-            count = 0
-            byteList = []
-            while (ord(layerInfo[count]) != 0):
-                byteList.append(layerInfo[count])
-                count += 1
-
-            strList = [byteValue.decode('utf-8') for byteValue in byteList]
-            str = ''.join(strList)
-
-            equal1, equal2, equal3, equal4 = findStrIndex("=", str)
-            line1, line2, line3, line4 = findStrIndex("|", str)
-
-            rawWidth = int(str[equal1 + 1:line1])
-            rawHeight = int(str[equal2 + 1:line2])
-            boundWidth = int(str[equal3 + 1:line3])
-            boundHeight = int(str[equal4 + 1:line4])
+            # copy the NUL-terminated string out in one call instead of
+            # indexing the pointer a byte at a time
+            str = ctypes.string_at(layerInfo).decode('utf-8')
+
+            # "key=value|" fields: rawWidth, rawHeight, boundWidth, boundHeight
+            fields = str.split('|', 4)[:4]
+            rawWidth, rawHeight, boundWidth, boundHeight = (
+                int(field.partition('=')[2]) for field in fields)
             w, h = rawWidth - boundWidth, rawHeight - boundHeight
             levelDimensions.append((w, h))
 
         return tuple(levelDimensions)
 
+    def get_thumbnail(self, size):
+        """Return a PIL.Image containing an RGB thumbnail of the image.
+
+        size:     the maximum size of the thumbnail.
+
+        The thumbnail is rendered from a single slide level of at most
+        THUMBNAIL_MAX_PIXELS pixels, so a very large request returns the
+        largest thumbnail that level allows rather than decoding level 0."""
+
+        width, height = self.level_dimensions[0]
+        # a thumbnail never needs more than the full slide
+        scale = min(size[0] / width, size[1] / height, 1)
+        thumb_w, thumb_h = int(width * scale), int(height * scale)
+
+        # decode the coarsest level that still holds at least as many pixels
+        # as the thumbnail, instead of a large level that is mostly thrown away
+        level = 0
+        for i, (level_w, level_h) in enumerate(self.level_dimensions):
+            if level_w >= thumb_w and level_h >= thumb_h:
+                level = i
+        # but never one too large to read whole
+        while (level < self.level_count - 1 and
+               self.level_dimensions[level][0] * self.level_dimensions[level][1] > self.THUMBNAIL_MAX_PIXELS):
+            level += 1
+
+        thumb = self.read_region((0, 0), level, self.level_dimensions[level])
+        thumb.thumbnail(size, Image.LANCZOS)
+        return thumb
+
     def close(self):
 
         so.SqCloseSdpc(self.sdpc)
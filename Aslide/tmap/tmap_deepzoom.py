@@ -1,5 +1,7 @@
 from io import BytesIO
 
+import numpy as np
+
 from Aslide.tmap import tmap_lowlevel, tmap_slide
 
 from xml.etree.ElementTree import ElementTree, Element, SubElement
@@ -15,6 +17,46 @@ class DeepZoomGenerator(object):
         self._z_overlap = overlap
         self._limit_bounds = limit_bounds
 
+        self._calculate_levels()
+
+    def _calculate_levels(self):
+        # the SDK serves tiles per native downsample, so each Deep Zoom level
+        # maps onto one native level, ordered from lowest to highest resolution
+        self._slide_w, self._slide_h = self.slide.dimensions
+        self._level_scales = tuple(int(d) for d in reversed(self.slide.level_downsamples))
+        self._level_count = len(self._level_scales)
+
+        # ceil divisions over all levels at once, in exact integer arithmetic
+        scales = np.asarray(self._level_scales, dtype=np.int64)
+        z_w = -(-self._slide_w // scales)
+        z_h = -(-self._slide_h // scales)
+        t_w = -(-z_w // self._z_t_downsample)
+        t_h = -(-z_h // self._z_t_downsample)
+
+        self._z_dimensions = tuple(zip(z_w.tolist(), z_h.tolist()))
+        self._t_dimensions = tuple(zip(t_w.tolist(), t_h.tolist()))
+        self._tile_count = int((t_w * t_h).sum())
+
+    @property
+    def level_count(self):
+        """The number of Deep Zoom levels in the image."""
+        return self._level_count
+
+    @property
+    def level_tiles(self):
+        """A list of (tiles_x, tiles_y) tuples for each Deep Zoom level."""
+        return self._t_dimensions
+
+    @property
+    def level_dimensions(self):
+        """A list of (pixels_x, pixels_y) tuples for each Deep Zoom level."""
+        return self._z_dimensions
+
+    @property
+    def tile_count(self):
+        """The total number of Deep Zoom tiles in the image."""
+        return self._tile_count
+
     def get_tile(self, level, address):
         """Return an RGB PIL.Image for a tile.
 
@@ -22,8 +64,25 @@ class DeepZoomGenerator(object):
         address:   the address of the tile within the level as a (col, row)
                    tuple."""
 
-        level = reversed(self.slide.level_downsamples)[level]
-        return tmap_lowlevel.get_tile_data(self._osr._osr, level, address[1], address[0])
+        scale = self._level_scales[level]
+        return tmap_lowlevel.get_tile_data(self._osr._osr, scale, address[1], address[0])
+
+    def get_tile_ndarray(self, level, address):
+        """Like get_tile(), but return an RGB uint8 array of shape
+        (height, width, 3) without going through a PIL image."""
+
+        scale = self._level_scales[level]
+        return tmap_lowlevel.get_tile_data_array(self._osr._osr, scale, address[1], address[0])
+
+    def get_tiles(self, level, addresses):
+        """Return a list of RGB PIL.Images for several tiles of one level.
+
+        level:     the Deep Zoom level.
+        addresses: a list of (col, row) tuples within the level."""
+
+        # GetTileData hands out a buffer shared by every call on the handle,
+        # so the tiles of one slide are read one after another
+        return [self.get_tile(level, address) for address in addresses]
 
     def get_dzi(self, format):
         """Return a string containing the XML metadata for the .dzi file.
@@ -33,7 +92,7 @@ class DeepZoomGenerator(object):
                         Overlap=str(self._z_overlap), Format=format,
                         xmlns='http://schemas.microsoft.com/deepzoom/2008')
 
-        w, h = self.slide.dimensions
+        w, h = self._slide_w, self._slide_h
         SubElement(image, 'Size', Width=str(w), Height=str(h))
         tree = ElementTree(element=image)
         buf = BytesIO()
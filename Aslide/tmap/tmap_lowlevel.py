@@ -2,8 +2,10 @@ import copy
 import ctypes
 import math
 import sys, os
+import threading
 import numpy as np
 from ctypes import *
+from functools import lru_cache
 from itertools import count
 
 from PIL import Image
@@ -82,18 +84,18 @@ def _func(name, restype, argtypes, errcheck=_check_error):
     return func
 
 
-def _handle_func(puc_list, W, H):
-    length = W * H * 3
-    try:
-        content = ctypes.string_at(puc_list, length)
-        data = np.fromstring(content, np.uint8).reshape((W, H, 3))
-        data= data[:, :, ::-1]
+def _handle_func(puc_list, H, W):
+    # the SDK returns packed BGR rows; view them in place and let PIL's raw
+    # decoder swap the channels while copying them into the image
+    content = ctypes.cast(puc_list, POINTER(c_ubyte * (W * H * 3))).contents
+    return Image.frombuffer('RGB', (W, H), content, 'raw', 'BGR', 0, 1)
 
-        image = Image.fromarray(np.asarray(data, dtype=np.uint8))
 
-        return image
-    except Exception as e:
-        raise e
+def _handle_func_array(puc_list, H, W):
+    # same as _handle_func, for callers that want an RGB uint8 array; the
+    # channel flip copies the pixels out of the SDK buffer
+    bgr = np.ctypeslib.as_array(puc_list, shape=(H, W, 3))
+    return np.ascontiguousarray(bgr[..., ::-1])
 
 
 # function to open a Tmap file
@@ -106,7 +108,16 @@ def open_tmap_file(name):
 
 
 # function to close a Tmap file
-close_tmap_file = _func('CloseTmapFile', None, [c_void_p], _check_close)
+_close_tmap_file = _func('CloseTmapFile', None, [c_void_p], _check_close)
+
+
+def close_tmap_file(slide):
+    # the SDK may hand the same handle value to a later open
+    _image_info_cache.pop(slide, None)
+    with _tile_locks_guard:
+        _tile_locks.pop(slide, None)
+    return _close_tmap_file(slide)
+
 
 # function to set the focus layer
 get_focus_number = _func('GetFocusNumber', c_int, [c_void_p])
@@ -141,8 +152,17 @@ class ImgSize(Structure):
 _get_image_info_ex = _func('GetImageInfoEx', ImgSize, [c_void_p, c_int])
 
 
+# ImgSize per slide handle and image type; image metadata never changes while
+# a file is open, so each (slide, etype) pair only crosses into the SDK once
+_image_info_cache = {}
+
+
 def get_image_info_ex(slide, etype):
-    img = _get_image_info_ex(slide, c_int(etype))
+    slide_cache = _image_info_cache.setdefault(slide, {})
+    img = slide_cache.get(etype)
+    if img is None:
+        img = _get_image_info_ex(slide, c_int(etype))
+        slide_cache[etype] = img
     return img
 
 
@@ -156,15 +176,15 @@ def get_level_count(slide):
 def get_level_layer(slide):
     max_fScale = get_scan_scale(slide)
 
-    layers = [max_fScale]
-    while max_fScale > 2:
-        max_fScale = max_fScale / 2
-        layers.append(max_fScale)
+    # halve the scan scale until it is no more than 2; for an integer scale
+    # that takes ceil(log2(scale)) - 1 steps, counted exactly in bits
+    layer_count = max(1, (max_fScale - 1).bit_length())
+    layers = [max_fScale] + [max_fScale / (1 << i) for i in range(1, layer_count)]
 
     return layers
 
 def get_level_dimensions(slide):
-    layer_count = len(get_level_layer(slide))
+    layer_count = get_level_count(slide)
 
     z_size = get_dimensions(slide)
 
@@ -177,8 +197,8 @@ def get_level_dimensions(slide):
 
 
 def get_level_downsamples(slide):
-    layer_count = len(get_level_layer(slide))
-    return tuple([np.power(2, i) for i in range(layer_count)])
+    layer_count = get_level_count(slide)
+    return tuple(1 << i for i in range(layer_count))
 
 # function to get the pixel size
 get_pixel_size = _func('GetPixelSize', c_int, [c_void_p])
@@ -188,10 +208,11 @@ _get_image_data = _func('GetImageData', c_int, [c_void_p, c_int, c_char_p, c_int
 
 
 def get_image_data(slide, etype):
-    img_info = _get_image_info_ex(slide, c_int(etype))
+    img_info = get_image_info_ex(slide, etype)
     nBufferLength = int(img_info.width * img_info.height * img_info.depth / 8)
-    pucImg = create_string_buffer(nBufferLength)
-    img_data = _get_image_data(slide, c_int(etype), pucImg, nBufferLength)
+    # the SDK overwrites the whole buffer, so skip create_string_buffer's memset
+    pucImg = np.empty(nBufferLength, dtype=np.uint8).ctypes.data_as(POINTER(c_ubyte))
+    img_data = _get_image_data(slide, c_int(etype), cast(pucImg, c_char_p), nBufferLength)
     if img_data:
         return _handle_func(pucImg, img_info.height, img_info.width)
 
@@ -226,17 +247,33 @@ def restore_location_in_level_0(nLeft, nTop, nRight, nBottom, level, max_fscale)
     return int(nLeft), int(nTop), int(nRight), int(nBottom)
 
 
-def get_crop_image_data_ex(slide, nIndex, nLeft, nTop, nRight, nBottom, level):
-    max_fScale = get_scan_scale(slide)
+@lru_cache(maxsize=16)
+def _level_crop_table(layers):
+    # per level: its scale, the integer scale the SDK is asked for, and the
+    # factor from that scale back to level 0; only a few scan scales exist
+    max_fScale = layers[0]
+    table = []
+    for fScale in layers:
+        fScale_ = math.ceil(fScale)
+        table.append((fScale, fScale_, max_fScale / fScale_))
+    return tuple(table)
 
-    layers = tuple(get_level_layer(slide))
 
-    fScale = layers[level]
-    fScale_ = math.ceil(fScale)
+def _crop_params(slide, nLeft, nTop, nRight, nBottom, level, layers):
+    # callers holding an open slide pass its layer scales to skip the SDK query
+    if layers is None:
+        layers = tuple(get_level_layer(slide))
+    fScale, fScale_, n = _level_crop_table(layers)[level]
 
-    nLeft, nTop, nRight, nBottom = int(nLeft * fScale_ / fScale), int(nTop * fScale_ / fScale), int(nRight * fScale_ / fScale), int(nBottom * fScale_ / fScale)
-    
-    nLeft, nTop, nRight, nBottom = restore_location_in_level_0(nLeft, nTop, nRight, nBottom, fScale_, max_fScale)
+    # same arithmetic, in the same order, as restore_location_in_level_0
+    # after the rescale to fScale_, so the rounding is unchanged
+    return (int(n * int(nLeft * fScale_ / fScale)), int(n * int(nTop * fScale_ / fScale)),
+            int(n * int(nRight * fScale_ / fScale)), int(n * int(nBottom * fScale_ / fScale)),
+            fScale_)
+
+
+def get_crop_image_data_ex(slide, nIndex, nLeft, nTop, nRight, nBottom, level, layers=None):
+    nLeft, nTop, nRight, nBottom, fScale_ = _crop_params(slide, nLeft, nTop, nRight, nBottom, level, layers)
 
     img_size = _get_image_size_ex(slide, nLeft, nTop, nRight, nBottom, fScale_)
     nBufferLength = img_size.imgsize
@@ -246,14 +283,84 @@ def get_crop_image_data_ex(slide, nIndex, nLeft, nTop, nRight, nBottom, level):
     return _handle_func(crop_image_data, img_size.height, img_size.width)
 
 
+# function to get the cropped image data into a caller-allocated buffer
+_get_crop_image_data = _func('GetCropImageData', c_bool,
+                             [c_void_p, c_int, c_int, c_int, c_int, c_int, c_float, c_char_p, c_int])
+
+
+def get_crop_image_data(slide, nIndex, nLeft, nTop, nRight, nBottom, level, layers=None, scratch=None,
+                        as_array=False):
+    # like get_crop_image_data_ex, but the SDK decodes into our own buffer;
+    # scratch (e.g. a threading.local) keeps that buffer between calls, and
+    # is grown only when a larger region comes along
+    nLeft, nTop, nRight, nBottom, fScale_ = _crop_params(slide, nLeft, nTop, nRight, nBottom, level, layers)
+
+    img_size = _get_image_size_ex(slide, nLeft, nTop, nRight, nBottom, fScale_)
+    nBufferLength = max(img_size.imgsize, img_size.width * img_size.height * 3)
+
+    buf = getattr(scratch, 'buffer', None)
+    if buf is None or buf.nbytes < nBufferLength:
+        buf = np.empty(nBufferLength, dtype=np.uint8)
+        if scratch is not None:
+            scratch.buffer = buf
+
+    pucImg = buf.ctypes.data_as(POINTER(c_ubyte))
+    if not _get_crop_image_data(slide, c_int(nIndex), nLeft, nTop, nRight, nBottom, fScale_,
+                                cast(pucImg, c_char_p), nBufferLength):
+        return None
+
+    # both conversions copy the pixels, so the buffer is free for the next call
+    if as_array:
+        return _handle_func_array(pucImg, img_size.height, img_size.width)
+    return _handle_func(pucImg, img_size.height, img_size.width)
+
+
 # function to get the tile data
 _get_tile_data = _func('GetTileData', POINTER(c_ubyte), [c_void_p, c_int, c_int, c_int])
 
 
-def get_tile_data(slide, n_downsample_scale, n_tile_row, n_tile_col):
+def get_tile_size(slide):
+    # image type 5 (uImageTile) describes a single SDK tile
+    img = get_image_info_ex(slide, 5)
+    return (img.width, img.height)
+
+
+# GetTileData has no memory block index: it returns SDK-owned memory that
+# the next call on the same handle may overwrite, so each call and the copy
+# out of its buffer run under a per-handle lock
+_tile_locks = {}
+_tile_locks_guard = threading.Lock()
+
+
+def _tile_lock(slide):
+    with _tile_locks_guard:
+        lock = _tile_locks.get(slide)
+        if lock is None:
+            lock = _tile_locks[slide] = threading.Lock()
+        return lock
+
+
+def _get_tile_raw(slide, n_downsample_scale, n_tile_row, n_tile_col):
+    # the SDK call alone; the returned pointer is only valid until the next
+    # GetTileData on this handle, so callers must hold _tile_lock(slide)
     tile_data = _get_tile_data(slide, n_downsample_scale, n_tile_row, n_tile_col)
+    tile_w, tile_h = get_tile_size(slide)
+
+    return tile_data, tile_h, tile_w
+
+
+def _tile_to_image(tile_data, H, W):
+    return _handle_func(tile_data, H, W)
+
+
+def get_tile_data(slide, n_downsample_scale, n_tile_row, n_tile_col):
+    with _tile_lock(slide):
+        return _tile_to_image(*_get_tile_raw(slide, n_downsample_scale, n_tile_row, n_tile_col))
+
 
-    return _handle_func(tile_data, 256, 256)
+def get_tile_data_array(slide, n_downsample_scale, n_tile_row, n_tile_col):
+    with _tile_lock(slide):
+        return _handle_func_array(*_get_tile_raw(slide, n_downsample_scale, n_tile_row, n_tile_col))
 
 
 def main():
@@ -1,7 +1,10 @@
 import math
+import queue
+import threading
 import numpy as np
 
 from openslide import AbstractSlide, _OpenSlideMap
+from openslide.lowlevel import OpenSlideUnsupportedFormatError
 from Aslide.tmap import tmap_lowlevel
 
 
@@ -15,10 +18,34 @@ Tags = {
 
 
 class TmapSlide(AbstractSlide):
+    # the SDK reserves memory blocks 0-30 (nIndex) for concurrent crops
+    CROP_SLOTS = 31
+
     def __init__(self, filename):
         AbstractSlide.__init__(self)
         self.__filename = filename
         self._osr = tmap_lowlevel.open_tmap_file(filename)
+        if not self._osr:
+            raise OpenSlideUnsupportedFormatError(
+                "Unsupported or missing image file")
+        self._thumb_cache = {}
+        # associated images by image type, decoded on first request
+        self._associated_cache = {}
+        # per-thread decode buffer reused by read_region
+        self._scratch = threading.local()
+        # free SDK memory blocks; each read_region call borrows one so that
+        # concurrent crops never share an nIndex
+        self._crop_slots = queue.LifoQueue()
+        for i in range(self.CROP_SLOTS):
+            self._crop_slots.put(i)
+
+        # the pyramid geometry is fixed once the file is open; query the SDK
+        # for it here rather than on every property access
+        self._level_layers = tuple(tmap_lowlevel.get_level_layer(self._osr))
+        self._level_dimensions = tmap_lowlevel.get_level_dimensions(self._osr)
+        self._level_downsamples = tmap_lowlevel.get_level_downsamples(self._osr)
+        # get_best_level_for_downsample() matches against the squared downsamples
+        self._level_presets = tuple(i * i for i in self._level_downsamples)
 
     def __repr__(self):
         return '%s(%r)' % (self.__class__.__name__, self.__filename)
@@ -55,29 +82,32 @@ class TmapSlide(AbstractSlide):
     def get_pixel_size(self):
         return tmap_lowlevel.get_pixel_size(self._osr)
 
+    # get native tile size
+    @property
+    def get_tile_size(self):
+        return tmap_lowlevel.get_tile_size(self._osr)
+
     @property
     def dimensions(self):
-        return tmap_lowlevel.get_dimensions(self._osr)
+        return self._level_dimensions[0]
 
     @property
     def level_count(self):
-        return tmap_lowlevel.get_level_count(self._osr)
+        return len(self._level_downsamples)
 
     @property
     def level_dimensions(self):
-        return tmap_lowlevel.get_level_dimensions(self._osr)
+        return self._level_dimensions
 
     @property
     def level_downsamples(self):
-        return tmap_lowlevel.get_level_downsamples(self._osr)
+        return self._level_downsamples
     
     
     def get_best_level_for_downsample(self, downsample):
-      
-        preset = [i*i for i in self.level_downsamples]
-        err = [abs(i-downsample) for i in preset]
-        level = err.index(min(err))
-        return level
+        # first level with the smallest error, as list.index(min(err)) gave
+        presets = self._level_presets
+        return min(range(len(presets)), key=lambda i: abs(presets[i] - downsample))
 
     # get image meta data
     def get_image_info_ex(self, etype):
@@ -97,26 +127,68 @@ class TmapSlide(AbstractSlide):
 
     def associated_images(self, tag):
         if tag in Tags:
-            return tmap_lowlevel.get_image_data(self._osr, Tags[tag])
+            etype = Tags[tag]
+            image = self._associated_cache.get(etype)
+            if image is None:
+                image = tmap_lowlevel.get_image_data(self._osr, etype)
+                if image is None:
+                    return None
+                self._associated_cache[etype] = image
+            return image.copy()
         else:
             # raise Exception("Unrecgnized associated_images type [{}], avaliable tags are [{}]".format(tag, ",".join(Tags)))
             return None
 
-    def read_region(self, location, level, size, nIndex=0):
+    def _read_crop(self, location, level, size, nIndex, as_array):
         nLeft = location[0]
         nTop = location[1]
         nRight = nLeft + size[0]
         nBottom = nTop + size[1]
-        
-        return tmap_lowlevel.get_crop_image_data_ex(self._osr, nIndex, nLeft, nTop, nRight, nBottom, level)
-
-    def get_thumbnail(self, size=None):
-        image = tmap_lowlevel.get_image_data(self._osr, 0)
-        if size:
-            return image.resize(size)
 
+        # without an explicit nIndex, borrow a free memory block for the
+        # duration of the call (blocking if all of them are in use)
+        slot = None
+        if nIndex is None:
+            nIndex = slot = self._crop_slots.get()
+        try:
+            image = tmap_lowlevel.get_crop_image_data(self._osr, nIndex, nLeft, nTop, nRight, nBottom, level,
+                                                      self._level_layers, self._scratch, as_array=as_array)
+            if image is None:
+                image = tmap_lowlevel.get_crop_image_data_ex(self._osr, nIndex, nLeft, nTop, nRight, nBottom,
+                                                             level, self._level_layers)
+                if as_array:
+                    image = np.asarray(image)
+        finally:
+            if slot is not None:
+                self._crop_slots.put(slot)
         return image
 
+    def read_region(self, location, level, size, nIndex=None):
+        return self._read_crop(location, level, size, nIndex, False)
+
+    def read_region_ndarray(self, location, level, size, nIndex=None):
+        """Like read_region(), but return an RGB uint8 array of shape
+        (height, width, 3) without going through a PIL image."""
+        return self._read_crop(location, level, size, nIndex, True)
+
+    def get_thumbnail(self, size=None):
+        # the SDK decodes the full thumbnail on every call, so keep the base
+        # image and each requested resize; callers get a private copy
+        key = tuple(size) if size else None
+        image = self._thumb_cache.get(key)
+        if image is None:
+            image = self._thumb_cache.get(None)
+            if image is None:
+                image = tmap_lowlevel.get_image_data(self._osr, 0)
+                if image is None:
+                    return None
+                self._thumb_cache[None] = image
+            if size:
+                image = image.resize(size)
+                self._thumb_cache[key] = image
+
+        return image.copy()
+
 
 def main():
     slide = TmapSlide('path/to/tmap/file')
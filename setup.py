@@ -45,4 +45,5 @@ setup(
     cmdclass={'install': CustomInstall},
     platforms='linux',
     install_requires=['numpy', 'Pillow', 'openslide-python'],
+    extras_require={'turbojpeg': ['PyTurboJPEG']},
 )
\ No newline at end of file
@@ -0,0 +1,69 @@
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+try:
+    from Aslide.deepzoom import ADeepZoomGenerator
+except OSError as e:
+    # the vendor SDKs are loaded at import time
+    pytest.skip("slide SDK unavailable: %s" % e, allow_module_level=True)
+
+
+class _Slide(object):
+    format = '.kfb'
+    filepath = 'slow.kfb'
+
+    def __init__(self):
+        self._osr = self
+        self.level_count = 1
+        self.level_dimensions = ((4096, 4096),)
+        self.level_downsamples = (1.0,)
+        self.dimensions = self.level_dimensions[0]
+        self.properties = {}
+
+    def get_best_level_for_downsample(self, downsample):
+        return 0
+
+
+class _SlowDZG(object):
+    # renders on the prefetch threads take long enough for the queue to fill
+    level_tiles = ((16, 16),)
+
+    def get_tile(self, level, address):
+        if threading.current_thread() is not threading.main_thread():
+            time.sleep(0.1)
+        return Image.new('RGB', (254, 254))
+
+
+def _generator():
+    dzg = ADeepZoomGenerator(_Slide(), tile_cache_size=100, prefetch_neighbours=True)
+    dzg._dzg = _SlowDZG()
+    return dzg
+
+
+def _finishes(func, timeout=10):
+    worker = threading.Thread(target=func, daemon=True)
+    worker.start()
+    worker.join(timeout)
+    return not worker.is_alive()
+
+
+def test_prefetch_eviction_does_not_deadlock():
+    dzg = _generator()
+
+    def pan():
+        for col in (1, 5, 9, 13):
+            dzg.get_tile(0, (col, col))
+
+    assert _finishes(pan)
+    assert len(dzg._prefetch_pending) <= dzg.MAX_PREFETCH_PENDING
+    assert _finishes(dzg.close)
+
+
+def test_close_with_pending_prefetch_does_not_deadlock():
+    dzg = _generator()
+    dzg.get_tile(0, (1, 1))
+    assert _finishes(dzg.close)
+    assert not dzg._prefetch_pending